@@ -0,0 +1,82 @@
+# migrate.py
+"""Apply migrations/*.sql in order; run as the release step.
+
+Every migration is idempotent and is replayed on each release. Statements run
+one at a time in autocommit, since CREATE/DROP INDEX CONCURRENTLY cannot run
+inside a transaction block.
+"""
+import glob
+import os
+import re
+import psycopg2
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+load_dotenv()  # harmless on Railway; useful locally
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+if not DATABASE_URL:
+    raise RuntimeError("DATABASE_URL is not set")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+def _statements(path):
+    """Split a migration file into statements (no ';' inside literals)."""
+    with open(path, encoding="utf-8") as f:
+        text = "".join(line for line in f if not line.lstrip().startswith("--"))
+    return [s.strip() for s in text.split(";") if s.strip()]
+
+def _managed_indexes(statements):
+    """Names of the indexes the migrations create."""
+    pattern = re.compile(r"CREATE\s+INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+    names = set()
+    for statement in statements:
+        m = pattern.match(statement)
+        if m:
+            names.add(m.group(1))
+    return names
+
+def drop_invalid_indexes(cur, names):
+    """Drop our indexes left INVALID by an interrupted concurrent build.
+
+    CREATE INDEX ... IF NOT EXISTS would skip them forever; replaying the
+    migrations afterwards rebuilds them.
+    """
+    if not names:
+        return
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = 'public' AND c.relname = ANY(%s);
+        """,
+        (sorted(names),),
+    )
+    for (name,) in cur.fetchall():
+        print(f"Dropping invalid index {name}")
+        cur.execute(
+            sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS public.{};").format(sql.Identifier(name))
+        )
+
+def main():
+    files = sorted(glob.glob(os.path.join(MIGRATIONS_DIR, "*.sql")))
+    migrations = [(path, _statements(path)) for path in files]
+
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            drop_invalid_indexes(
+                cur, _managed_indexes(s for _, stmts in migrations for s in stmts)
+            )
+            for path, statements in migrations:
+                print(f"Applying {os.path.basename(path)}")
+                for statement in statements:
+                    cur.execute(statement)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+-- 002_order_status_covering_index.sql: drop the pre-covering /order-status index.
+-- Idempotent; run outside a transaction (CONCURRENTLY).
+
+-- 001 now creates idx_orders_phone_status, which has the same key columns.
+-- This only cleans up databases that still carry the old index.
+DROP INDEX CONCURRENTLY IF EXISTS idx_orders_phone_id;
@@ -1,9 +1,15 @@
 # staff_app.py
 import os
-import json
-from flask import Flask, request, jsonify
+import re
+import msgspec
+import orjson
+import redis
+from flask import Flask, Response, request, g
 from flask_cors import CORS
 import psycopg2
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
 
 load_dotenv()  # harmless on Railway; useful locally
@@ -15,138 +21,331 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
 
-def _jsonify_items(raw):
-    """raw may be JSONB (already a Python obj) or a JSON/text string."""
-    if raw is None:
-        return []
-    if isinstance(raw, (dict, list)):
-        return raw
+# PREPARE hot statements once per connection and EXECUTE them by name, so the
+# backend skips parse/plan on every request. Prepared statements live in one
+# backend session: only enable this against Postgres directly or PgBouncer in
+# session mode, never transaction mode.
+PREPARE_STATEMENTS = os.getenv("PREPARE_STATEMENTS") == "1"
+
+class _PreparingConnection(PgConnection):
+    """Connection that remembers which statements it has PREPAREd."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+# One pool per worker process. Point DATABASE_URL at PgBouncer (transaction
+# pooling, port 6432) in production. search_path is applied as a startup
+# option so no request has to issue SET. Behind PgBouncer, "options" must be
+# listed in ignore_startup_parameters or the bouncer refuses the connection;
+# the bouncer then drops it and the server default search_path (public) holds.
+POOL = ThreadedConnectionPool(
+    minconn=int(os.getenv("DB_POOL_MIN", "5")),
+    maxconn=int(os.getenv("DB_POOL_MAX", "20")),
+    dsn=DATABASE_URL,
+    options="-c search_path=public",
+    connection_factory=_PreparingConnection,
+)
+
+# Optional read cache in front of /get-orders and /order-status. Writes bust
+# the affected keys after commit; the TTLs bound staleness if a bust is lost.
+# Short socket timeouts keep an unreachable Redis from stalling requests: a
+# timeout is a RedisError and falls through to Postgres like any other.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.1"))
+cache = (
+    redis.Redis.from_url(
+        REDIS_URL,
+        socket_timeout=REDIS_TIMEOUT,
+        socket_connect_timeout=REDIS_TIMEOUT,
+    )
+    if REDIS_URL
+    else None
+)
+
+# Bump the version whenever the cached value's format changes, so workers
+# from old and new deploys never read each other's entries.
+ORDERS_KEY = "orders:active:v2"
+ORDERS_TTL = 5
+STATUS_TTL = 10
+
+def _status_key(phone, order_id=None):
+    return f"status:{phone}:{order_id}" if order_id else f"status:{phone}"
+
+def _cache_get(key):
+    if cache is None:
+        return None
     try:
-        return json.loads(raw)
-    except Exception:
-        return []
+        return cache.get(key)
+    except redis.RedisError:
+        app.logger.exception("Cache read failed")
+        return None
+
+def _cache_set(key, ttl, value):
+    if cache is None:
+        return
+    try:
+        cache.setex(key, ttl, value)
+    except redis.RedisError:
+        app.logger.exception("Cache write failed")
+
+def _cache_bust(*keys):
+    if cache is None or not keys:
+        return
+    try:
+        cache.delete(*keys)
+    except redis.RedisError:
+        app.logger.exception("Cache invalidation failed")
+
+class OrderIn(msgspec.Struct):
+    """Body of POST /submit-order, decoded straight from the request bytes.
+
+    Fields accept null (e.g. no table for takeaway); submit_order maps
+    null and empty values to defaults. total may arrive as a string.
+    """
+    name: str | None = None
+    phone: str | None = None
+    table: str | None = None
+    items: list | None = None
+    total: float | str | None = None
+
+def _json(obj, status=200):
+    """JSON response encoded with orjson (UTF-8 bytes, no Python encoder)."""
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+def _dumps(obj):
+    """orjson encoder for psycopg2's Json adapter, which expects str."""
+    return orjson.dumps(obj).decode()
+
+def get_db():
+    """Pooled connection for the current request; returned on teardown.
+
+    Each connection is pinged first. Ones whose backend died while they sat
+    in the pool (restart, pg_terminate_backend) are discarded and replaced
+    instead of failing the request.
+    """
+    if "db" not in g:
+        g.db = _live_conn()
+    return g.db
 
-def _conn():
-    """New connection per request; sets search_path to public."""
-    conn = psycopg2.connect(DATABASE_URL)
-    with conn.cursor() as cur:
-        cur.execute("SET search_path TO public;")
-    return conn
+def _live_conn():
+    # A dead backend only shows up on the next query, so ping. The ping opens
+    # the request's transaction, which the route's `with conn` commits. After
+    # a restart every idle connection may be dead; once the idle ones are used
+    # up the pool opens a fresh connection, so this is bounded.
+    for _ in range(POOL.maxconn + 1):
+        conn = POOL.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            return conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            POOL.putconn(conn, close=True)
+    return POOL.getconn()
+
+@app.teardown_appcontext
+def _put_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        POOL.putconn(conn)
+
+# ---------------- SQL ----------------
+# Built once at import; the same string objects are reused by every request
+# and double as the PREPARE text when PREPARE_STATEMENTS is on.
+_SQL_SUBMIT_ORDER = """
+    INSERT INTO orders (name, phone, table_number, item, total, status, created_at)
+    VALUES (%s, %s, %s, %s::jsonb, %s, DEFAULT, DEFAULT)
+    RETURNING id;
+"""
+# /get-orders in one round-trip. fp.etag hashes the id and row version (xmin)
+# of every active order, so it changes whenever the set of rows or any row's
+# contents does, even when concurrent submits commit out of id order. The
+# payload is an uncorrelated subquery (an InitPlan), evaluated only when the
+# CASE needs it, i.e. when none of the client's ETags match.
+_SQL_GET_ORDERS = """
+    SELECT
+        fp.etag,
+        CASE WHEN fp.etag = ANY(%s::text[]) THEN NULL ELSE (
+            SELECT COALESCE(
+                jsonb_agg(
+                    jsonb_build_object(
+                        'id', id,
+                        'name', name,
+                        'phone', phone,
+                        'table', table_number,
+                        'items', COALESCE(item, '[]'::jsonb),
+                        'total', COALESCE(total, 0)
+                    )
+                    ORDER BY id
+                ),
+                '[]'::jsonb
+            )::text
+            FROM orders
+            WHERE status IS DISTINCT FROM 'completed'
+        ) END
+    FROM (
+        SELECT md5(COALESCE(string_agg(id || ':' || xmin, ',' ORDER BY id), '')) AS etag
+        FROM orders
+        WHERE status IS DISTINCT FROM 'completed'
+    ) AS fp;
+"""
+_SQL_DELETE_ORDER = "UPDATE orders SET status = 'completed' WHERE id = %s RETURNING phone;"
+_SQL_DELETE_ALL_ORDERS = """
+    UPDATE orders SET status = 'completed'
+    WHERE status IS DISTINCT FROM 'completed'
+    RETURNING id, phone;
+"""
+_SQL_DELETE_ITEM = """
+    UPDATE orders
+    SET item   = item - %s::int,
+        total  = COALESCE((
+            SELECT SUM((e->>'price')::float8)
+            FROM jsonb_array_elements(item - %s::int) AS e
+        ), 0),
+        status = CASE WHEN jsonb_array_length(item - %s::int) = 0
+                      THEN 'completed' ELSE status END
+    WHERE id = %s AND %s < jsonb_array_length(item)
+    RETURNING jsonb_array_length(item), phone;
+"""
+_SQL_ORDER_EXISTS = "SELECT 1 FROM orders WHERE id = %s;"
+_SQL_ORDER_STATUS_BY_ID = "SELECT status FROM orders WHERE id=%s AND phone=%s;"
+_SQL_ORDER_STATUS_LATEST = "SELECT status FROM orders WHERE phone=%s ORDER BY id DESC LIMIT 1;"
+
+def _execute(cur, name, sql, params=()):
+    """Run a hot statement, via PREPARE/EXECUTE when PREPARE_STATEMENTS is on."""
+    if not PREPARE_STATEMENTS:
+        cur.execute(sql, params)
+        return
+    conn = cur.connection
+    if name not in conn.prepared:
+        n = iter(range(1, len(params) + 1))
+        cur.execute(f"PREPARE {name} AS " + re.sub(r"%s", lambda _: f"${next(n)}", sql))
+        conn.prepared.add(name)
+    args = "(" + ", ".join(["%s"] * len(params)) + ")" if params else ""
+    cur.execute(f"EXECUTE {name}{args};", params)
 
 @app.route("/", methods=["GET"])
 def health():
-    return {"ok": True}
+    return _json({"ok": True})
 
 # ---------------- Submit order ----------------
 @app.route("/submit-order", methods=["POST"])
 def submit_order():
-    data  = request.get_json(force=True, silent=True) or {}
-    name  = (data.get("name") or "").strip()
-    phone = (data.get("phone") or "").strip()
-    table = (data.get("table") or "").strip()
-    items = data.get("items") or []
-    total = float(data.get("total") or 0)
+    try:
+        order = msgspec.json.decode(request.get_data(), type=OrderIn)
+        total = float(order.total or 0)
+    except (msgspec.DecodeError, ValueError):
+        return _json({"error": "Invalid order payload"}, 400)
+    name  = (order.name or "").strip()
+    phone = (order.phone or "").strip()
+    table = (order.table or "").strip()
+    items = order.items or []
 
     try:
-        with _conn() as conn, conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO orders (name, phone, table_number, item, total, status, created_at)
-                VALUES (%s, %s, %s, %s, %s, DEFAULT, DEFAULT)
-                RETURNING id;
-                """,
-                (name, phone, table, json.dumps(items, ensure_ascii=False), total),
+        with get_db() as conn, conn.cursor() as cur:
+            _execute(
+                cur,
+                "submit_order",
+                _SQL_SUBMIT_ORDER,
+                (name, phone, table, Json(items, dumps=_dumps), total),
             )
             order_id = cur.fetchone()[0]
-        return jsonify({"message": "Order received successfully!", "order_id": order_id}), 200
+        _cache_bust(ORDERS_KEY, _status_key(phone))
+        return _json({"message": "Order received successfully!", "order_id": order_id}, 200)
     except Exception as e:
         app.logger.exception("Error in /submit-order")
-        return jsonify({"error": "Failed to submit order"}), 500
+        return _json({"error": "Failed to submit order"}, 500)
 
 # ---------------- Get active orders ----------------
 @app.route("/get-orders", methods=["GET"])
 def get_orders():
-    try:
-        with _conn() as conn, conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT id, name, phone, table_number, item, total
-                FROM orders
-                WHERE status IS DISTINCT FROM 'completed'
-                ORDER BY id ASC;
-                """
-            )
-            rows = cur.fetchall()
+    # The cache holds b"<etag>\n<payload>" so a hit can answer 304 on its own.
+    cached = _cache_get(ORDERS_KEY)
+    if cached is not None:
+        etag, _, payload = cached.partition(b"\n")
+        return _orders_response(etag.decode(), payload)
 
-        orders = []
-        for row in rows:
-            row_id, name, phone, table_number, item_raw, total = row
-            orders.append({
-                "id": row_id,
-                "name": name,
-                "phone": phone,
-                "table": table_number,
-                "items": _jsonify_items(item_raw),
-                "total": float(total or 0),
-            })
-        return jsonify(orders), 200
+    try:
+        with get_db() as conn, conn.cursor() as cur:
+            # One round-trip: Postgres returns the ETag, and shapes and encodes
+            # the whole array only when the client's copy is stale.
+            client_tags = list(request.if_none_match.as_set(include_weak=True))
+            _execute(cur, "get_orders", _SQL_GET_ORDERS, (client_tags,))
+            etag, payload = cur.fetchone()
+        if payload is not None:
+            _cache_set(ORDERS_KEY, ORDERS_TTL, f"{etag}\n{payload}")
+        return _orders_response(etag, payload)
     except Exception as e:
         app.logger.exception("Error in /get-orders")
-        return jsonify({"error": "Failed to retrieve orders"}), 500
+        return _json({"error": "Failed to retrieve orders"}, 500)
+
+def _orders_response(etag, payload):
+    """200 with the payload, or 304 if the client already has this ETag."""
+    if payload is None or request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(payload, status=200, mimetype="application/json")
+    resp.set_etag(etag, weak=True)
+    return resp
 
 # ---------------- Mark one order completed ----------------
 @app.route("/delete-order/<int:order_id>", methods=["DELETE"])
 def delete_order(order_id):
     try:
-        with _conn() as conn, conn.cursor() as cur:
-            cur.execute("UPDATE orders SET status = 'completed' WHERE id = %s;", (order_id,))
-        return jsonify({"message": "Order marked as completed!"}), 200
+        with get_db() as conn, conn.cursor() as cur:
+            _execute(cur, "delete_order", _SQL_DELETE_ORDER, (order_id,))
+            row = cur.fetchone()
+        if row:
+            _cache_bust(ORDERS_KEY, _status_key(row[0]), _status_key(row[0], order_id))
+        return _json({"message": "Order marked as completed!"}, 200)
     except Exception:
         app.logger.exception("Error in /delete-order")
-        return jsonify({"error": "Failed to update order status"}), 500
+        return _json({"error": "Failed to update order status"}, 500)
 
 # ---------------- Mark all orders completed ----------------
 @app.route("/delete-all-orders", methods=["DELETE"])
 def delete_all_orders():
     try:
-        with _conn() as conn, conn.cursor() as cur:
-            cur.execute("UPDATE orders SET status = 'completed' WHERE status IS DISTINCT FROM 'completed';")
-        return jsonify({"message": "All orders marked as completed!"}), 200
+        with get_db() as conn, conn.cursor() as cur:
+            _execute(cur, "delete_all_orders", _SQL_DELETE_ALL_ORDERS)
+            rows = cur.fetchall()
+        keys = {ORDERS_KEY}
+        for row_id, phone in rows:
+            keys.update((_status_key(phone), _status_key(phone, row_id)))
+        _cache_bust(*keys)
+        return _json({"message": "All orders marked as completed!"}, 200)
     except Exception:
         app.logger.exception("Error in /delete-all-orders")
-        return jsonify({"error": "Failed to update orders"}), 500
+        return _json({"error": "Failed to update orders"}, 500)
 
 # ---------------- Delete one item & recalc total ----------------
 @app.route("/delete-item/<int:order_id>/<int:item_index>", methods=["POST"])
 def delete_item(order_id, item_index):
     try:
-        with _conn() as conn, conn.cursor() as cur:
-            cur.execute("SELECT item FROM orders WHERE id = %s;", (order_id,))
+        with get_db() as conn, conn.cursor() as cur:
+            # One statement: bounds check, drop the element, re-sum the total,
+            # and complete the order if it emptied. The row lock taken by the
+            # UPDATE makes concurrent edits serialize instead of clobbering.
+            _execute(
+                cur,
+                "delete_item",
+                _SQL_DELETE_ITEM,
+                (item_index, item_index, item_index, order_id, item_index),
+            )
             row = cur.fetchone()
-            if not row:
-                return jsonify({"error": "Order not found"}), 404
+            if row is None:
+                # Only the failure path pays for a second lookup.
+                cur.execute(_SQL_ORDER_EXISTS, (order_id,))
+                if cur.fetchone() is None:
+                    return _json({"error": "Order not found"}, 404)
+                return _json({"error": "Item index out of range"}, 400)
 
-            items = _jsonify_items(row[0])
-            if not (0 <= item_index < len(items)):
-                return jsonify({"error": "Item index out of range"}), 400
-
-            items.pop(item_index)
-
-            if items:
-                new_total = sum(float(i.get("price", 0)) for i in items)
-                cur.execute(
-                    "UPDATE orders SET item = %s, total = %s WHERE id = %s;",
-                    (json.dumps(items, ensure_ascii=False), new_total, order_id),
-                )
-            else:
-                cur.execute(
-                    "UPDATE orders SET status = 'completed', total = 0 WHERE id = %s;",
-                    (order_id,),
-                )
-        return jsonify({"message": "Item deleted and total updated!"}), 200
+        _cache_bust(ORDERS_KEY, _status_key(row[1]), _status_key(row[1], order_id))
+        if row[0] == 0:
+            return _json({"message": "Last item deleted; order completed!"}, 200)
+        return _json({"message": "Item deleted and total updated!"}, 200)
     except Exception:
         app.logger.exception("Error in /delete-item")
-        return jsonify({"error": "Failed to delete item"}), 500
+        return _json({"error": "Failed to delete item"}, 500)
 
 # ---------------- Order status by phone (or specific id) ----------------
 @app.route("/order-status", methods=["GET"])
@@ -155,24 +354,28 @@ def order_status():
     order_id = request.args.get("order", type=int)
 
     if not phone:
-        return jsonify({"found": False, "error": "phone_required"}), 400
+        return _json({"found": False, "error": "phone_required"}, 400)
+
+    key = _status_key(phone, order_id)
+    cached = _cache_get(key)
+    if cached is not None:
+        return _json({"found": True, "status": cached.decode()}, 200)
 
     try:
-        with _conn() as conn, conn.cursor() as cur:
+        with get_db() as conn, conn.cursor() as cur:
             if order_id:
-                cur.execute("SELECT status FROM orders WHERE id=%s AND phone=%s;", (order_id, phone))
+                _execute(cur, "order_status_by_id", _SQL_ORDER_STATUS_BY_ID, (order_id, phone))
             else:
-                cur.execute(
-                    "SELECT status FROM orders WHERE phone=%s ORDER BY id DESC LIMIT 1;",
-                    (phone,),
-                )
+                _execute(cur, "order_status_latest", _SQL_ORDER_STATUS_LATEST, (phone,))
             row = cur.fetchone()
         if row:
-            return jsonify({"found": True, "status": row[0]}), 200
-        return jsonify({"found": False}), 404
+            if row[0] is not None:
+                _cache_set(key, STATUS_TTL, row[0])
+            return _json({"found": True, "status": row[0]}, 200)
+        return _json({"found": False}, 404)
     except Exception:
         app.logger.exception("Error in /order-status")
-        return jsonify({"found": False, "error": "server"}), 500
+        return _json({"found": False, "error": "server"}, 500)
 
 if __name__ == "__main__":
     app.run(debug=True, port=int(os.getenv("PORT", "5000")), host="0.0.0.0")